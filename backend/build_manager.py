@@ -1,85 +1,306 @@
 import os
 import asyncio
+import codecs
+import errno
+import hashlib
 import logging
 import shutil
-import json
 import time
-from typing import AsyncGenerator, Dict, Any, Optional
+from typing import AsyncGenerator, Dict, Any, List, Optional, Tuple
 from asyncio.subprocess import Process
 
+import orjson
+
+try:
+    from backend.json_store import write_json_atomic
+except ImportError:
+    # Fallback for interactive runs from inside backend/ (see main.py)
+    from json_store import write_json_atomic
+
 logger = logging.getLogger('klipperfleet.build')
 
+# copy_file_range errors that just mean "not supported here" (cross-device,
+# old kernel, filesystem without support); fall back to a regular copy.
+_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL}
+
+
+def _fast_copy(src: str, dst: str) -> None:
+    """Copies src to dst in-kernel with copy_file_range where available.
+
+    On filesystems that support it (btrfs, XFS) this becomes a reflink; falls
+    back to shutil.copyfile otherwise. Mode bits are copied like shutil.copy.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+        return
+    complete = False
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            remaining = os.fstat(src_fd).st_size
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        # Some filesystems (procfs, FUSE) report 0 instead of
+                        # an error; don't leave dst truncated.
+                        break
+                    remaining -= copied
+                complete = remaining == 0
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    except OSError as e:
+        if e.errno not in _COPY_FALLBACK_ERRNOS:
+            raise
+    if not complete:
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
 
 class BuildManager:
     def __init__(self, klipper_dir: str, artifacts_dir: str) -> None:
         self.klipper_dir: str = klipper_dir
         self.artifacts_dir: str = artifacts_dir
         self._last_build_info: Dict[str, Dict[str, Any]] = {}
+        # (inode, mtime_ns) of each .build_info.json as last loaded
+        self._build_info_stamps: Dict[str, Tuple[int, int]] = {}
+        self._version_cache_file: str = os.path.join(
+            artifacts_dir, '.version_cache.json'
+        )
+        self._version_cache: Dict[str, Tuple[List[int], Dict[str, str]]] = {}
         os.makedirs(self.artifacts_dir, exist_ok=True)
         self._load_build_info_from_disk()
+        self._load_version_cache_from_disk()
 
     def _load_build_info_from_disk(self) -> None:
-        """Loads any saved .build_info.json files from the artifacts directory."""
+        """Loads saved .build_info.json files from the artifacts directory.
+
+        Safe to call repeatedly: files whose (inode, mtime) haven't changed
+        since the last load are not re-read (so an unparsable file is only
+        reported once), and profiles whose file has gone (e.g. renamed or
+        deleted profiles) are dropped.
+        """
+        seen = set()
         try:
-            for filename in os.listdir(self.artifacts_dir):
-                if filename.endswith('.build_info.json'):
-                    profile_name = filename.replace('.build_info.json', '')
-                    filepath = os.path.join(self.artifacts_dir, filename)
-                    with open(filepath, 'r') as f:
-                        self._last_build_info[profile_name] = json.load(f)
+            with os.scandir(self.artifacts_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith('.build_info.json'):
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    profile_name = entry.name[:-len('.build_info.json')]
+                    seen.add(profile_name)
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        stamp = (st.st_ino, st.st_mtime_ns)
+                        if self._build_info_stamps.get(profile_name) == stamp:
+                            continue
+                        fd = os.open(entry.path, os.O_RDONLY)
+                        try:
+                            data = os.read(fd, st.st_size)
+                        finally:
+                            os.close(fd)
+                        # Stamp before parsing so a corrupt file isn't
+                        # retried (and logged) on every lookup
+                        self._build_info_stamps[profile_name] = stamp
+                        self._last_build_info.pop(profile_name, None)
+                        self._last_build_info[profile_name] = orjson.loads(data)
+                    except Exception as e:
+                        logger.warning('Could not load build info %s: %s', entry.name, e)
         except Exception as e:
             logger.warning('Could not load build info from disk: %s', e)
+            return
+        for profile_name in set(self._build_info_stamps) - seen:
+            del self._build_info_stamps[profile_name]
+        for profile_name in set(self._last_build_info) - seen:
+            del self._last_build_info[profile_name]
 
-    async def get_klipper_version(self) -> Dict[str, str]:
-        """Gets the current Klipper git version info."""
-        version_info: Dict[str, str] = {
-            'version': 'unknown',
-            'commit': 'unknown',
-            'date': 'unknown',
+    def _load_version_cache_from_disk(self) -> None:
+        """Loads the persisted git version cache from the artifacts directory."""
+        if not os.path.exists(self._version_cache_file):
+            return
+        try:
+            with open(self._version_cache_file, 'rb') as f:
+                data: Dict[str, Any] = orjson.loads(f.read())
+            for klipper_dir, entry in data.items():
+                self._version_cache[klipper_dir] = (
+                    list(entry['key']),
+                    dict(entry['info']),
+                )
+        except Exception as e:
+            logger.warning('Could not load version cache from disk: %s', e)
+
+    def _save_version_cache_to_disk(self) -> None:
+        """Atomically writes the git version cache to the artifacts directory."""
+        data = {
+            klipper_dir: {'key': key, 'info': info}
+            for klipper_dir, (key, info) in self._version_cache.items()
         }
         try:
-            # Get the short commit hash
-            process: Process = await asyncio.create_subprocess_exec(
+            write_json_atomic(self._version_cache_file, data)
+        except Exception as e:
+            logger.warning('Could not save version cache to disk: %s', e)
+
+    def _version_cache_key(self) -> Optional[List[int]]:
+        """Returns the mtimes of the git files that change the describe output.
+
+        Covers .git/HEAD (checkouts), the branch ref it points to (commits,
+        pulls), packed-refs (gc'd refs) and the refs/tags directory (tags
+        added or removed, e.g. by 'git fetch --tags'). The index is
+        deliberately left out since 'git describe --dirty' rewrites it on
+        every run. Returns None when .git is not a plain directory (e.g. a
+        worktree), in which case the version is never cached.
+        """
+        git_dir = os.path.join(self.klipper_dir, '.git')
+        head_path = os.path.join(git_dir, 'HEAD')
+        try:
+            with open(head_path, 'r') as f:
+                head = f.read().strip()
+        except OSError:
+            return None
+        paths = [
+            head_path,
+            os.path.join(git_dir, 'packed-refs'),
+            os.path.join(git_dir, 'refs', 'tags'),
+        ]
+        if head.startswith('ref: '):
+            paths.append(os.path.join(git_dir, head[5:]))
+        key: List[int] = []
+        for path in paths:
+            try:
+                key.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                key.append(0)
+        return key
+
+    async def _is_worktree_dirty(self) -> Optional[bool]:
+        """Checks whether tracked files in the Klipper checkout differ from HEAD.
+
+        Matches 'git describe --dirty': untracked files are ignored. Uses
+        status rather than diff-index since it refreshes stale index stat
+        info first, so touched-but-unchanged files don't count as edits.
+        Returns None if git could not answer (e.g. not a repository).
+        """
+        try:
+            proc = await asyncio.create_subprocess_exec(
                 'git',
-                'describe',
-                '--always',
-                '--tags',
-                '--dirty',
-                '--long',
+                'status',
+                '--porcelain',
+                '--untracked-files=no',
                 cwd=self.klipper_dir,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.DEVNULL,
             )
-            stdout, _ = await process.communicate()
-            if process.returncode == 0:
-                version_info['version'] = stdout.decode().strip()
+            stdout, _ = await proc.communicate()
+        except Exception as e:
+            logger.error('Error checking Klipper working tree: %s', e)
+            return None
+        if proc.returncode != 0:
+            return None
+        return bool(stdout.strip())
 
-            # Get the full commit hash
-            process = await asyncio.create_subprocess_exec(
+    async def _is_worktree_pristine(self) -> bool:
+        """Checks that the Klipper checkout has no modified or untracked files.
+
+        Stricter than _is_worktree_dirty: untracked sources (e.g. Kalico user
+        modules in src/extras/) end up in the firmware too. Ignored files
+        such as out/ and .config don't count.
+        """
+        try:
+            proc = await asyncio.create_subprocess_exec(
                 'git',
-                'rev-parse',
-                'HEAD',
+                'status',
+                '--porcelain',
+                '--untracked-files=normal',
                 cwd=self.klipper_dir,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.DEVNULL,
             )
-            stdout, _ = await process.communicate()
-            if process.returncode == 0:
-                version_info['commit'] = stdout.decode().strip()[:12]
+            stdout, _ = await proc.communicate()
+        except Exception as e:
+            logger.error('Error checking Klipper working tree: %s', e)
+            return False
+        return proc.returncode == 0 and not stdout.strip()
 
-            # Get the commit date
-            process = await asyncio.create_subprocess_exec(
-                'git',
-                'log',
-                '-1',
-                '--format=%ci',
-                cwd=self.klipper_dir,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.DEVNULL,
+    async def get_klipper_version(self) -> Dict[str, str]:
+        """Gets the current Klipper git version info.
+
+        Clean versions are cached against the mtimes of the git metadata
+        files, so repeated calls only run a quick dirtiness check until HEAD
+        actually moves.
+        """
+        cache_key = self._version_cache_key()
+        cached = self._version_cache.get(self.klipper_dir)
+        if cache_key is not None and cached is not None and cached[0] == cache_key:
+            # The key only tracks git refs, so working tree edits are picked up
+            # with a cheap status check instead of a full describe.
+            dirty = await self._is_worktree_dirty()
+            if dirty is not None:
+                version_info = dict(cached[1])
+                if dirty:
+                    version_info['version'] += '-dirty'
+                return version_info
+
+        version_info: Dict[str, str] = {
+            'version': 'unknown',
+            'commit': 'unknown',
+            'date': 'unknown',
+        }
+        try:
+            # describe and log are independent, so run both git processes
+            # concurrently. log emits the full hash and commit date in one
+            # call, separated by a unit separator (0x1f).
+            describe_proc, log_proc = await asyncio.gather(
+                asyncio.create_subprocess_exec(
+                    'git',
+                    'describe',
+                    '--always',
+                    '--tags',
+                    '--dirty',
+                    '--long',
+                    cwd=self.klipper_dir,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                ),
+                asyncio.create_subprocess_exec(
+                    'git',
+                    'log',
+                    '-1',
+                    '--format=%H%x1f%ci',
+                    cwd=self.klipper_dir,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                ),
             )
-            stdout, _ = await process.communicate()
-            if process.returncode == 0:
-                version_info['date'] = stdout.decode().strip()
+            (describe_out, _), (log_out, _) = await asyncio.gather(
+                describe_proc.communicate(), log_proc.communicate()
+            )
+            if describe_proc.returncode == 0:
+                version_info['version'] = describe_out.decode().strip()
+            if log_proc.returncode == 0:
+                commit, _, date = log_out.decode().strip().partition('\x1f')
+                if commit:
+                    version_info['commit'] = commit[:12]
+                if date:
+                    version_info['date'] = date
+
+            # Only clean versions are cached; the -dirty suffix is re-derived
+            # on every cache hit.
+            if (
+                cache_key is not None
+                and describe_proc.returncode == 0
+                and log_proc.returncode == 0
+                and not version_info['version'].endswith('-dirty')
+            ):
+                self._version_cache[self.klipper_dir] = (
+                    cache_key,
+                    dict(version_info),
+                )
+                self._save_version_cache_to_disk()
 
         except Exception as e:
             logger.error('Error getting Klipper version: %s', e)
@@ -87,17 +308,74 @@ class BuildManager:
 
     def get_last_build_info(self, profile: str) -> Optional[Dict[str, Any]]:
         """Returns the build info for the last successful build of a profile."""
+        # Pick up profiles renamed or removed on disk since the last call
+        self._load_build_info_from_disk()
         return self._last_build_info.get(profile)
 
+    async def _is_build_cached(
+        self,
+        profile_name: str,
+        config_sha: str,
+        custom_make_command: Optional[str],
+        version_info: Dict[str, str],
+    ) -> bool:
+        """Checks whether the last successful build of a profile is still current.
+
+        The stored artifacts are reused only when the profile's .config, the
+        custom make command and the Klipper commit all match the last build
+        and every artifact that build saved is still present. Builds from a
+        dirty (including untracked files) or unknown Klipper tree are never
+        reused.
+        """
+        info = self.get_last_build_info(profile_name)
+        if not info or info.get('config_sha') != config_sha:
+            return False
+        if info.get('custom_make_command') != custom_make_command:
+            return False
+        if version_info['commit'] == 'unknown':
+            return False
+        if version_info['version'].endswith('-dirty'):
+            return False
+        if info.get('version') != version_info['version']:
+            return False
+        if info.get('commit') != version_info['commit']:
+            return False
+        artifacts: List[str] = info.get('artifacts') or []
+        if not artifacts or not all(
+            os.path.exists(os.path.join(self.artifacts_dir, name))
+            for name in artifacts
+        ):
+            return False
+        # Checked directly rather than trusting the version string, which may
+        # come from a cache and ignores untracked files
+        return await self._is_worktree_pristine()
+
     async def run_build(self, config_path: str, custom_make_command: Optional[str] = None) -> AsyncGenerator[str, None]:
         """Runs the Klipper build process and yields output line by line."""
         profile_name: str = os.path.basename(config_path).replace('.config', '')
 
+        # 0. Skip the build entirely if nothing changed since the last one
+        try:
+            with open(config_path, 'rb') as f:
+                config_sha: str = hashlib.sha256(f.read()).hexdigest()
+        except Exception as e:
+            yield f'!!! Error reading config: {str(e)}\n'
+            return
+        version_info = await self.get_klipper_version()
+        if await self._is_build_cached(profile_name, config_sha, custom_make_command, version_info):
+            yield (
+                '>>> Configuration and firmware source unchanged since last '
+                'build, reusing cached artifacts\n'
+            )
+            yield '>>> Build successful!\n'
+            yield f'>>> Klipper version: {version_info["version"]} ({version_info["commit"]})\n'
+            return
+
         # Klipper's Makefile doesn't handle spaces in KCONFIG_CONFIG well.
         # We copy the profile to the standard .config location in the klipper directory.
         tmp_config: str = os.path.join(self.klipper_dir, '.config')
         try:
-            shutil.copy(config_path, tmp_config)
+            _fast_copy(config_path, tmp_config)
         except Exception as e:
             yield f'!!! Error copying config: {str(e)}\n'
             return
@@ -118,22 +396,29 @@ class BuildManager:
             yield f'!!! Error during make olddefconfig: {str(e)}\n'
             return
 
-        # 3. Build (use all available CPU cores for faster compilation)
+        # 3. Build (use all available CPU cores for faster compilation).
+        # MAKEFLAGS carries the job count into custom build commands too, which
+        # invoke make themselves; an explicit MAKEFLAGS from the service
+        # environment wins.
+        nproc = os.cpu_count() or 1
+        build_env = dict(os.environ)
+        build_env.setdefault('MAKEFLAGS', f'-j{nproc}')
         if custom_make_command:
             yield f'>>> Starting build (custom: {custom_make_command})...\n'
             process: Process = await asyncio.create_subprocess_exec(
                 'bash', '-c', custom_make_command,
                 cwd=self.klipper_dir,
+                env=build_env,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.STDOUT,
             )
         else:
-            nproc = os.cpu_count() or 1
             yield f'>>> Starting build (-j{nproc})...\n'
             process: Process = await asyncio.create_subprocess_exec(
                 'make',
                 f'-j{nproc}',
                 cwd=self.klipper_dir,
+                env=build_env,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.STDOUT,
             )
@@ -143,6 +428,15 @@ class BuildManager:
         stall_timeout_s = 120  # 2 minutes without output
         start_time = time.monotonic()
         timed_out = False
+        # Read output in large chunks rather than line by line, so a chatty
+        # build doesn't cost an event loop wakeup per line; complete lines are
+        # split out of the buffer and yielded individually.
+        #
+        # One incremental decoder for the whole stream: it carries multi-byte
+        # UTF-8 sequences split across chunk boundaries, and replaces invalid
+        # bytes instead of aborting the build log.
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pending = ''
         while True:
             elapsed = time.monotonic() - start_time
             if elapsed > build_timeout_s:
@@ -150,16 +444,24 @@ class BuildManager:
                 yield f'!!! Build timed out after {build_timeout_s}s\n'
                 break
             try:
-                line: bytes = await asyncio.wait_for(
-                    process.stdout.readline(), timeout=stall_timeout_s
+                chunk: bytes = await asyncio.wait_for(
+                    process.stdout.read(65536), timeout=stall_timeout_s
                 )
             except asyncio.TimeoutError:
                 timed_out = True
                 yield f'!!! Build stalled (no output for {stall_timeout_s}s)\n'
                 break
-            if not line:
+            if not chunk:
+                pending += decoder.decode(b'', final=True)
+                if pending:
+                    yield pending
                 break
-            yield line.decode()
+            pending += decoder.decode(chunk)
+            end = pending.rfind('\n') + 1
+            if end:
+                for line in pending[:end - 1].split('\n'):
+                    yield line + '\n'
+                pending = pending[end:]
 
         if timed_out:
             try:
@@ -173,7 +475,8 @@ class BuildManager:
         if process.returncode == 0:
             yield '>>> Build successful!\n'
 
-            # Get version info for this build
+            # Get version info for this build (re-read in case HEAD moved
+            # while building)
             version_info = await self.get_klipper_version()
             yield f'>>> Klipper version: {version_info["version"]} ({version_info["commit"]})\n'
 
@@ -184,30 +487,35 @@ class BuildManager:
                 self.klipper_dir, 'out', 'klipper.elf.hex'
             )
             uf2_src: str = os.path.join(self.klipper_dir, 'out', 'klipper.uf2')
+            artifacts: List[str] = []
 
             if os.path.exists(bin_src):
-                shutil.copy(
+                _fast_copy(
                     bin_src,
                     os.path.join(self.artifacts_dir, f'{profile_name}.bin'),
                 )
+                artifacts.append(f'{profile_name}.bin')
                 yield f'>>> Saved artifact: {profile_name}.bin\n'
             if os.path.exists(elf_src):
-                shutil.copy(
+                _fast_copy(
                     elf_src,
                     os.path.join(self.artifacts_dir, f'{profile_name}.elf'),
                 )
+                artifacts.append(f'{profile_name}.elf')
                 yield f'>>> Saved artifact: {profile_name}.elf\n'
             if os.path.exists(hex_src):
-                shutil.copy(
+                _fast_copy(
                     hex_src,
                     os.path.join(self.artifacts_dir, f'{profile_name}.elf.hex'),
                 )
+                artifacts.append(f'{profile_name}.elf.hex')
                 yield f'>>> Saved artifact: {profile_name}.elf.hex\n'
             if os.path.exists(uf2_src):
-                shutil.copy(
+                _fast_copy(
                     uf2_src,
                     os.path.join(self.artifacts_dir, f'{profile_name}.uf2'),
                 )
+                artifacts.append(f'{profile_name}.uf2')
                 yield f'>>> Saved artifact: {profile_name}.uf2\n'
 
             # Store build info for later retrieval
@@ -216,14 +524,22 @@ class BuildManager:
                 'commit': version_info['commit'],
                 'date': version_info['date'],
                 'built_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'config_sha': config_sha,
+                'custom_make_command': custom_make_command,
+                'artifacts': artifacts,
             }
 
             # Save build info to a JSON file for persistence
             build_info_path = os.path.join(
                 self.artifacts_dir, f'{profile_name}.build_info.json'
             )
-            with open(build_info_path, 'w') as f:
-                json.dump(self._last_build_info[profile_name], f, indent=2)
+            write_json_atomic(
+                build_info_path,
+                self._last_build_info[profile_name],
+                option=orjson.OPT_INDENT_2,
+            )
+            st = os.stat(build_info_path)
+            self._build_info_stamps[profile_name] = (st.st_ino, st.st_mtime_ns)
         else:
             yield f'>>> Build failed with return code {process.returncode}\n'
 
@@ -1,109 +1,207 @@
 import asyncio
-import json
+import logging
 import os
 import time
 from typing import List, Dict, Any, Optional
 
+import orjson
+
+try:
+    from backend.json_store import write_json_atomic
+except ImportError:
+    # Fallback for interactive runs from inside backend/ (see main.py)
+    from json_store import write_json_atomic
+
+logger = logging.getLogger('klipperfleet.fleet')
+
+# Number of journaled operations after which fleet.json is rewritten and the
+# journal truncated.
+JOURNAL_COMPACT_THRESHOLD = 100
+
+
 class FleetManager:
+    """Registry of fleet devices.
+
+    The fleet is held in memory, keyed by device ID. Each mutation appends a
+    single JSON line to fleet.journal instead of rewriting fleet.json; the
+    snapshot is rewritten (and the journal truncated) every
+    JOURNAL_COMPACT_THRESHOLD operations and on startup after replay.
+    """
+
     def __init__(self, data_dir: str) -> None:
         self.data_dir: str = data_dir
         self.fleet_file: str = os.path.join(data_dir, "fleet.json")
+        self.journal_file: str = os.path.join(data_dir, "fleet.journal")
+        # One lock for the whole fleet is enough: every critical section is an
+        # in-memory dict update plus at most one journal append, with no await
+        # inside, so there is no contention worth sharding by device ID.
         self._lock = asyncio.Lock()
+        self._fleet: Dict[str, Dict[str, Any]] = {}
+        self._journal_fd: Optional[int] = None
+        self._journal_ops: int = 0
         self._ensure_data_dir()
+        self._load()
 
     def _ensure_data_dir(self) -> None:
         os.makedirs(self.data_dir, exist_ok=True)
         if not os.path.exists(self.fleet_file):
-            with open(self.fleet_file, 'w') as f:
-                json.dump([], f)
+            with open(self.fleet_file, 'wb') as f:
+                f.write(orjson.dumps([]))
+
+    def _load(self) -> None:
+        """Loads the fleet.json snapshot and replays any pending journal entries."""
+        with open(self.fleet_file, 'rb') as f:
+            fleet: List[Dict[str, Any]] = orjson.loads(f.read())
+        self._fleet = {d['id']: d for d in fleet}
+
+        if not os.path.exists(self.journal_file):
+            return
+        replayed = 0
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._apply(orjson.loads(line))
+                except (ValueError, KeyError) as e:
+                    # A torn final line from a crash mid-append; everything
+                    # before it has already been applied.
+                    logger.warning('Skipping corrupt fleet journal entry: %s', e)
+                    continue
+                replayed += 1
+        if replayed:
+            logger.info('Replayed %d fleet journal entries', replayed)
+        self._compact()
+
+    def _apply(self, op: Dict[str, Any]) -> None:
+        """Applies a single journal operation to the in-memory fleet."""
+        kind = op['op']
+        if kind == 'upsert':
+            device: Dict[str, Any] = op['device']
+            old_id: Optional[str] = op.get('old_id')
+            if old_id and old_id != device['id'] and old_id in self._fleet:
+                # Rename in place so the device keeps its position in the list
+                renamed: Dict[str, Dict[str, Any]] = {}
+                for k, v in self._fleet.items():
+                    if k == old_id:
+                        renamed[device['id']] = device
+                    elif k != device['id']:
+                        renamed[k] = v
+                self._fleet = renamed
+            else:
+                self._fleet[device['id']] = device
+        elif kind == 'remove':
+            self._fleet.pop(op['id'], None)
+        elif kind == 'replace':
+            self._fleet = {d['id']: d for d in op['fleet']}
+        else:
+            raise KeyError(f"Unknown fleet journal op: {kind}")
+
+    def _commit(self, op: Dict[str, Any]) -> None:
+        """Appends an operation to the journal, then applies it in memory.
+
+        The in-memory fleet is only touched once the write has succeeded, so a
+        failed append never leaves memory ahead of what is on disk.
+        """
+        if self._journal_fd is None:
+            self._journal_fd = os.open(
+                self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        os.write(
+            self._journal_fd, orjson.dumps(op, option=orjson.OPT_APPEND_NEWLINE)
+        )
+        self._apply(op)
+        self._journal_ops += 1
+        if self._journal_ops >= JOURNAL_COMPACT_THRESHOLD:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Rewrites fleet.json from memory and truncates the journal."""
+        self._write_fleet(list(self._fleet.values()))
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        self._journal_ops = 0
+
+    def _write_fleet(self, fleet: List[Dict[str, Any]]) -> None:
+        """Atomically writes the fleet data to disk."""
+        write_json_atomic(self.fleet_file, fleet, option=orjson.OPT_INDENT_2)
+
+    async def compact(self) -> None:
+        """Flushes all journaled changes into fleet.json."""
+        async with self._lock:
+            self._compact()
 
     async def get_fleet(self) -> List[Dict[str, Any]]:
         """Returns the list of registered devices in the fleet."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                return json.load(f)
+            return [d.copy() for d in self._fleet.values()]
 
-    def _write_fleet(self, fleet: List[Dict[str, Any]]) -> None:
-        """Atomically writes the fleet data to disk."""
-        tmp_path = self.fleet_file + ".tmp"
-        with open(tmp_path, 'w') as f:
-            json.dump(fleet, f, indent=4)
-        os.replace(tmp_path, self.fleet_file)
+    async def replace_fleet(self, fleet: List[Dict[str, Any]]) -> None:
+        """Replaces the whole fleet (e.g. when restoring a backup)."""
+        async with self._lock:
+            self._apply({'op': 'replace', 'fleet': fleet})
+            self._compact()
 
     async def save_device(self, device: Dict[str, Any]) -> None:
         """Adds or updates a device in the fleet."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                fleet: List[Dict[str, Any]] = json.load(f)
-            old_id: Optional[str] = device.get('old_id')
-            target_id = old_id if old_id else device['id']
-            
-            # Check if device already exists by ID or old_id
             save_data = device.copy()
-            save_data.pop('old_id', None)
-            for i, d in enumerate(fleet):
-                if d['id'] == target_id:
-                    fleet[i] = save_data
-                    break
-            else:
-                fleet.append(save_data)
-            
-            self._write_fleet(fleet)
+            old_id: Optional[str] = save_data.pop('old_id', None)
+            op: Dict[str, Any] = {'op': 'upsert', 'device': save_data}
+            if old_id:
+                op['old_id'] = old_id
+            self._commit(op)
 
     async def remove_device(self, device_id: str) -> None:
         """Removes a device from the fleet."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                fleet: List[Dict[str, Any]] = json.load(f)
-            fleet = [d for d in fleet if d['id'] != device_id]
-            self._write_fleet(fleet)
+            if device_id in self._fleet:
+                self._commit({'op': 'remove', 'id': device_id})
 
     async def update_device_version(self, device_id: str, version_info: Dict[str, Any]) -> None:
         """Updates the version information for a device after flashing."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                fleet: List[Dict[str, Any]] = json.load(f)
-            for d in fleet:
-                if d['id'] == device_id:
-                    d['last_flashed'] = time.strftime("%Y-%m-%d %H:%M:%S")
-                    d['flashed_version'] = version_info.get('version', 'unknown')
-                    d['flashed_commit'] = version_info.get('commit', 'unknown')
-                    break
-            self._write_fleet(fleet)
+            d = self._fleet.get(device_id)
+            if d is None:
+                return
+            d = d.copy()
+            d['last_flashed'] = time.strftime("%Y-%m-%d %H:%M:%S")
+            d['flashed_version'] = version_info.get('version', 'unknown')
+            d['flashed_commit'] = version_info.get('commit', 'unknown')
+            self._commit({'op': 'upsert', 'device': d})
 
     async def update_device_id(self, old_id: str, new_id: str) -> bool:
         """Updates the device ID in fleet.json when a device re-enumerates with a new path.
         Returns True if the ID was found and updated."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                fleet: List[Dict[str, Any]] = json.load(f)
-            for d in fleet:
-                if d['id'] == old_id:
-                    d['id'] = new_id
-                    self._write_fleet(fleet)
-                    return True
-            return False
+            d = self._fleet.get(old_id)
+            if d is None:
+                return False
+            d = d.copy()
+            d['id'] = new_id
+            self._commit({'op': 'upsert', 'old_id': old_id, 'device': d})
+            return True
 
     async def update_device_live_version(self, device_id: str, live_version: str) -> None:
         """Updates the live running version for a device (from Moonraker query)."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                fleet: List[Dict[str, Any]] = json.load(f)
-            for d in fleet:
-                if d['id'] == device_id:
-                    d['live_version'] = live_version
-                    break
-            self._write_fleet(fleet)
+            d = self._fleet.get(device_id)
+            # Polled continuously; don't journal a write when nothing changed
+            if d is None or d.get('live_version') == live_version:
+                return
+            d = d.copy()
+            d['live_version'] = live_version
+            self._commit({'op': 'upsert', 'device': d})
 
     async def rename_profile(self, old_name: str, new_name: str) -> None:
         """Updates all fleet devices referencing a given profile to the new name."""
         async with self._lock:
-            with open(self.fleet_file, 'r') as f:
-                fleet: List[Dict[str, Any]] = json.load(f)
-            changed = False
-            for d in fleet:
+            for d in list(self._fleet.values()):
                 if d.get('profile') == old_name:
+                    d = d.copy()
                     d['profile'] = new_name
-                    changed = True
-            if changed:
-                self._write_fleet(fleet)
+                    self._commit({'op': 'upsert', 'device': d})
@@ -0,0 +1,20 @@
+"""
+Atomic JSON persistence shared by the backend managers.
+"""
+
+import os
+from typing import Any
+
+import orjson
+
+
+def write_json_atomic(path: str, data: Any, option: int = 0) -> None:
+    """Writes data as JSON to a temp file and renames it over path.
+
+    Readers (and a crash mid-write) only ever see the old or the new file,
+    never a partially written one. option is passed through to orjson.dumps.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data, option=option))
+    os.replace(tmp_path, path)
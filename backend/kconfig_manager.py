@@ -1,22 +1,72 @@
 import asyncio
+import hashlib
 import logging
 import os
 import subprocess
 import sys
 from typing import List, Dict, Any, Optional
 
+import orjson
+
+try:
+    from backend.json_store import write_json_atomic
+except ImportError:
+    # Fallback for interactive runs from inside backend/ (see main.py)
+    from json_store import write_json_atomic
+
 logger = logging.getLogger("klipperfleet.kconfig")
 
 # Global placeholder for the kconfiglib module
 kconfiglib: Any = None
 _is_klipper_kconfiglib = False
 
+# kconfiglib names used on the tree serialization hot path, bound once when
+# the module is imported (see _bind_kconfiglib)
+_Choice: Any = None
+_SYMBOL_OR_CHOICE: tuple = ()
+_expr_value: Any = None
+_TYPE_MAP: Dict[int, str] = {}
+
+# Symbols under Klipper's "Optional features" menu, which show_optional forces
+# visible
+_WANT_PREFIXES = ("WANT_", "CONFIG_WANT_")
+
+
+def _bind_kconfiglib(k_lib: Any, is_klipper: bool) -> None:
+    global kconfiglib, _is_klipper_kconfiglib
+    global _Choice, _SYMBOL_OR_CHOICE, _expr_value, _TYPE_MAP
+    kconfiglib = k_lib
+    _is_klipper_kconfiglib = is_klipper
+    _Choice = k_lib.Choice
+    _SYMBOL_OR_CHOICE = (k_lib.Symbol, k_lib.Choice)
+    _expr_value = k_lib.expr_value
+    _TYPE_MAP = {
+        k_lib.BOOL: "bool",
+        k_lib.TRISTATE: "tristate",
+        k_lib.STRING: "string",
+        k_lib.INT: "int",
+        k_lib.HEX: "hex",
+        k_lib.UNKNOWN: "unknown"
+    }
+
+
 class KconfigManager:
-    def __init__(self, klipper_dir: str) -> None:
+    def __init__(self, klipper_dir: str, cache_dir: Optional[str] = None) -> None:
         self.klipper_dir: str = klipper_dir
         self.kconfig_file: str = os.path.join(klipper_dir, "src", "Kconfig")
         self.kconf = None
         self._kconfig_lock: asyncio.Lock = asyncio.Lock()
+        # Persistent menu tree cache (disabled when cache_dir is None). Only
+        # trees for the default configuration (no .config loaded, no values
+        # set) are cached, since those depend on nothing but the Kconfig files.
+        self.cache_dir: Optional[str] = cache_dir
+        self._pristine: bool = False
+        self._tree_cache_files: List[str] = []
+        self._tree_cache_fingerprint: Optional[str] = None
+        self._cached_trees: Optional[Dict[str, List[Dict[str, Any]]]] = None
+        # Trees built from the currently loaded kconf, keyed by show_optional.
+        # Cleared whenever the Kconfig is reloaded or a value changes.
+        self._tree_memo: Dict[bool, List[Dict[str, Any]]] = {}
         self._import_kconfiglib()
 
     @property
@@ -24,7 +74,6 @@ class KconfigManager:
         return _is_klipper_kconfiglib
 
     def _import_kconfiglib(self) -> None:
-        global kconfiglib, _is_klipper_kconfiglib
         if kconfiglib is not None:
             return
 
@@ -35,8 +84,7 @@ class KconfigManager:
             sys.path.insert(0, kconfig_lib_path)
             try:
                 import kconfiglib as k_lib
-                kconfiglib = k_lib
-                _is_klipper_kconfiglib = True
+                _bind_kconfiglib(k_lib, is_klipper=True)
                 logger.info("Loaded kconfiglib from %s", kconfig_lib_path)
                 return
             except ImportError:
@@ -45,16 +93,125 @@ class KconfigManager:
         # Fallback to system kconfiglib
         try:
             import kconfiglib as k_lib
-            kconfiglib = k_lib
-            _is_klipper_kconfiglib = False
+            _bind_kconfiglib(k_lib, is_klipper=False)
             logger.info("Loaded system kconfiglib")
         except ImportError:
             raise ImportError("Could not load kconfiglib from Klipper directory or system.")
 
-    async def load_kconfig(self, config_file: Optional[str] = None) -> None:
-        """Loads the Kconfig file and optionally an existing .config file."""
+    async def load_kconfig(
+        self,
+        config_file: Optional[str] = None,
+        need_kconf: bool = False,
+        show_optional: bool = False,
+    ) -> None:
+        """Loads the Kconfig file and optionally an existing .config file.
+
+        Without a config_file, a valid on-disk tree cache holding the
+        show_optional tree the caller will ask for can stand in for the
+        parse. Callers that go on to call set_value/save_config must pass
+        need_kconf=True so the parse happens here, in a worker thread, rather
+        than later on the event loop.
+        """
         async with self._kconfig_lock:
-            self._load_kconfig_sync(config_file)
+            self._set_srctree()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None,
+                self._load_kconfig_or_cache,
+                config_file,
+                need_kconf,
+                show_optional,
+            )
+
+    def _set_srctree(self) -> None:
+        """Points the environment variables Klipper's Kconfig expects at this tree.
+
+        os.environ is process-wide, so this is done before every parse rather
+        than once per manager. It is always called on the event loop thread,
+        never from the executor, so it can't race with run_build copying the
+        environment.
+        """
+        abs_klipper_dir: str = os.path.abspath(self.klipper_dir)
+        os.environ["SRCTREE"] = abs_klipper_dir
+        os.environ["srctree"] = abs_klipper_dir
+
+    def _load_kconfig_or_cache(
+        self, config_file: Optional[str], need_kconf: bool, show_optional: bool
+    ) -> None:
+        self._tree_memo.clear()
+        if (
+            not config_file
+            and not need_kconf
+            and self._load_tree_cache()
+            and self._tree_cache_key(show_optional) in (self._cached_trees or {})
+        ):
+            self.kconf = None
+            return
+        self._load_kconfig_sync(config_file)
+
+    @staticmethod
+    def _tree_cache_key(show_optional: bool) -> str:
+        return "optional" if show_optional else "default"
+
+    def _tree_cache_path(self) -> str:
+        assert self.cache_dir is not None
+        key = hashlib.blake2b(
+            os.path.abspath(self.kconfig_file).encode(), digest_size=8
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"kconfig_{key}.json")
+
+    @staticmethod
+    def _fingerprint(paths: List[str]) -> Optional[str]:
+        """Hashes the mtime and size of every file, without reading them.
+
+        kconfig_manager.py itself is included so that changes to the tree
+        serializer invalidate old caches. Returns None if a file is missing.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr(getattr(kconfiglib, "VERSION", None)).encode())
+        for path in [os.path.abspath(__file__)] + paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            h.update(f"{path}\0{st.st_mtime_ns}\0{st.st_size}\0".encode())
+        return h.hexdigest()
+
+    def _load_tree_cache(self) -> bool:
+        """Loads the on-disk tree cache if it matches the current Kconfig files."""
+        if self.cache_dir is None:
+            return False
+        try:
+            with open(self._tree_cache_path(), "rb") as f:
+                data: Dict[str, Any] = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return False
+        files: List[str] = data.get("files", [])
+        fingerprint = self._fingerprint(files)
+        if fingerprint is None or fingerprint != data.get("fingerprint"):
+            return False
+        self._tree_cache_files = files
+        self._tree_cache_fingerprint = fingerprint
+        self._cached_trees = data.get("trees", {})
+        return True
+
+    def _store_tree_cache(self, key: str, tree: List[Dict[str, Any]]) -> None:
+        """Adds a freshly built default tree to the on-disk cache."""
+        if self.cache_dir is None or self._tree_cache_fingerprint is None:
+            return
+        if self._cached_trees is None:
+            self._cached_trees = {}
+        self._cached_trees[key] = tree
+        data = {
+            "files": self._tree_cache_files,
+            "fingerprint": self._tree_cache_fingerprint,
+            "trees": self._cached_trees,
+        }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_json_atomic(self._tree_cache_path(), data)
+        except OSError as e:
+            logger.warning("Could not write Kconfig tree cache: %s", e)
 
     def _run_firmware_extras_script(self, klipper_dir: str) -> None:
         """Run Kalico's find-firmware-extras.sh if present to generate src/extras/Kconfig.
@@ -94,10 +251,8 @@ class KconfigManager:
 
     def _load_kconfig_sync(self, config_file: Optional[str] = None) -> None:
         """Internal synchronous kconfig loading, called under lock."""
-        # Set environment variables that Klipper's Kconfig expects
+        self._tree_memo.clear()
         abs_klipper_dir: str = os.path.abspath(self.klipper_dir)
-        os.environ["SRCTREE"] = abs_klipper_dir
-        os.environ["srctree"] = abs_klipper_dir
         
         if not os.path.exists(self.kconfig_file):
             raise FileNotFoundError(f"Kconfig file not found at {self.kconfig_file}")
@@ -105,18 +260,11 @@ class KconfigManager:
         # Handle Kalico/fork-specific setup before parsing Kconfig
         self._run_firmware_extras_script(abs_klipper_dir)
 
-        # Use absolute kconfig_file path so kconfiglib doesn't need CWD to resolve
-        # relative 'source' directives. We set SRCTREE/srctree above which handles
-        # most resolution, but some older kconfiglib versions also check CWD.
-        # Instead of os.chdir (which is process-wide and not concurrency-safe),
-        # we pass the absolute path and set the environment variables.
+        # kconfiglib resolves relative 'source' directives against $srctree
+        # (see _set_srctree), which it reads once in the constructor, so
+        # there's no need to chdir (process-wide) into the Klipper directory.
         abs_kconfig_file: str = os.path.abspath(self.kconfig_file)
-        old_cwd: str = os.getcwd()
-        os.chdir(abs_klipper_dir)
-        try:
-            self.kconf = kconfiglib.Kconfig(abs_kconfig_file, warn=False)
-        finally:
-            os.chdir(old_cwd)
+        self.kconf = kconfiglib.Kconfig(abs_kconfig_file, warn=False)
 
         # Force certain symbols to 'y' to improve UX (e.g. show optimization menus)
         for sym_name in ["HAVE_LIMITED_CODE_SIZE", "LOW_LEVEL_OPTIONS"]:
@@ -132,27 +280,73 @@ class KconfigManager:
 
         if config_file and os.path.exists(config_path := os.path.expanduser(config_file)):
             self.kconf.load_config(config_path)
+            self._pristine = False
+        else:
+            self._pristine = True
+            self._refresh_tree_cache_fingerprint()
+
+    def _refresh_tree_cache_fingerprint(self) -> None:
+        """Records the Kconfig files behind the freshly parsed default config."""
+        if self.cache_dir is None:
+            return
+        assert self.kconf is not None
+        filenames = getattr(self.kconf, "kconfig_filenames", None)
+        if filenames is None:
+            # Very old kconfiglib: no way to know which files were sourced
+            self._tree_cache_fingerprint = None
+            return
+        files = sorted({os.path.join(self.kconf.srctree, f) for f in filenames})
+        fingerprint = self._fingerprint(files)
+        if fingerprint != self._tree_cache_fingerprint:
+            self._cached_trees = None
+        self._tree_cache_files = files
+        self._tree_cache_fingerprint = fingerprint
 
     def get_menu_tree(self, show_optional: bool = False) -> List[Dict[str, Any]]:
         """Returns a JSON-serializable tree of the Kconfig menu."""
+        if show_optional in self._tree_memo:
+            return self._tree_memo[show_optional]
+
+        cache_key = self._tree_cache_key(show_optional)
         if not self.kconf:
+            if self._cached_trees is not None and cache_key in self._cached_trees:
+                return self._cached_trees[cache_key]
+            self._set_srctree()
             self._load_kconfig_sync()
         
         assert self.kconf is not None
-        return self._parse_menu_item(self.kconf.top_node, show_optional=show_optional)
+        tree = self._parse_menu_item(self.kconf.top_node, show_optional=show_optional)
+        if self._pristine:
+            self._store_tree_cache(cache_key, tree)
+        self._tree_memo[show_optional] = tree
+        return tree
 
     def _parse_menu_item(self, node, show_optional: bool = False) -> List[Dict[str, Any]]:
-        items = []
-        curr = node.list
-        while curr:
-            item: Dict[str, Any] | None = self._serialize_node(curr, show_optional=show_optional)
-            if item:
-                # Recursively parse children if it's a menu or has a list
-                if curr.list:
-                    item["children"] = self._parse_menu_item(curr, show_optional=show_optional)
-                items.append(item)
-            curr = curr.next
-        return items
+        """Serializes the children of a node into a nested list of items.
+
+        Walks the menu depth-first with an explicit stack instead of recursing
+        per submenu. Each stack entry holds the next sibling to resume at and
+        the list that sibling's items belong to.
+        """
+        serialize = self._serialize_node
+        root: List[Dict[str, Any]] = []
+        stack = [(node.list, root)]
+        while stack:
+            curr, items = stack.pop()
+            while curr:
+                item: Optional[Dict[str, Any]] = serialize(curr, show_optional=show_optional)
+                if item:
+                    items.append(item)
+                    # Descend into menus (or anything else with a list) and
+                    # come back for the remaining siblings afterwards
+                    if curr.list:
+                        children: List[Dict[str, Any]] = []
+                        item["children"] = children
+                        stack.append((curr.next, items))
+                        curr, items = curr.list, children
+                        continue
+                curr = curr.next
+        return root
 
     def _serialize_node(self, node, show_optional: bool = False) -> Optional[Dict[str, Any]]:
         """Serializes a Kconfig node into a dictionary for the UI."""
@@ -162,29 +356,13 @@ class KconfigManager:
         if not node.prompt:
             return None
 
-        # Check symbol visibility if it's a symbol or choice
-        if isinstance(sym, (kconfiglib.Symbol, kconfiglib.Choice)):
-            # Symbols with no prompt are internal, don't show them
-            if not node.prompt:
-                return None
-            
-            # Force visibility for WANT_ symbols (Optional Features) if requested
-            is_want_sym = show_optional and sym.name and (sym.name.startswith("WANT_") or sym.name.startswith("CONFIG_WANT_"))
-            
-            # If it has a prompt but is currently invisible due to dependencies
-            if not is_want_sym and sym.visibility == 0:
-                return None
-
         # If it's a menu or comment
-        if not isinstance(sym, (kconfiglib.Symbol, kconfiglib.Choice)):
-            if not node.prompt:
-                return None
-            
+        if not isinstance(sym, _SYMBOL_OR_CHOICE):
             prompt_text, prompt_cond = node.prompt
             # Force "Optional features" menu to be visible if requested
             is_optional_menu = show_optional and "Optional features" in prompt_text
             
-            if not is_optional_menu and kconfiglib.expr_value(prompt_cond) == 0:
+            if not is_optional_menu and _expr_value(prompt_cond) == 0:
                 return None
 
             return {
@@ -194,41 +372,41 @@ class KconfigManager:
                 "visible": True,
             }
 
+        # Force visibility for WANT_ symbols (Optional Features) if requested
+        is_want_sym = show_optional and bool(sym.name) and sym.name.startswith(_WANT_PREFIXES)
+
+        # If it has a prompt but is currently invisible due to dependencies
+        if not is_want_sym and sym.visibility == 0:
+            return None
+
         # Handle Symbols and Choices
-        type_map: Dict[int, str] = {
-            kconfiglib.BOOL: "bool",
-            kconfiglib.TRISTATE: "tristate",
-            kconfiglib.STRING: "string",
-            kconfiglib.INT: "int",
-            kconfiglib.HEX: "hex",
-            kconfiglib.UNKNOWN: "unknown"
-        }
-        
+        is_choice = isinstance(sym, _Choice)
+
         # Generate a unique name for anonymous choices using prompt and line number
-        if isinstance(sym, kconfiglib.Choice) and not sym.name:
+        if is_choice and not sym.name:
             name: str = f"__choice_{node.prompt[0]}_{node.linenr}"
         else:
             name: str = sym.name if hasattr(sym, 'name') and sym.name else f"__node_{node.prompt[0]}_{node.linenr}"
 
         entry = {
             "name": name,
-            "type": type_map.get(sym.type, "unknown"),
+            "type": _TYPE_MAP.get(sym.type, "unknown"),
             "prompt": node.prompt[0],
             "default": sym.str_value,
             "value": sym.str_value,
             "help": getattr(node, 'help', None),
-            "visible": kconfiglib.expr_value(node.dep) > 0 or (show_optional and name and "WANT_" in name),
+            "visible": _expr_value(node.dep) > 0 or is_want_sym,
             "dep_str": str(node.dep),
             "choices": [],
             "readonly": False
         }
 
-        if isinstance(sym, kconfiglib.Symbol):
+        if not is_choice:
             # If it's a symbol selected by others, it's readonly
-            if hasattr(sym, 'rev_dep') and kconfiglib.expr_value(sym.rev_dep) > 0:
+            if hasattr(sym, 'rev_dep') and _expr_value(sym.rev_dep) > 0:
                 entry["readonly"] = True
         
-        if isinstance(sym, kconfiglib.Choice):
+        if is_choice:
             entry["type"] = "choice"
             
             # Filter visible choices first
@@ -262,9 +440,12 @@ class KconfigManager:
     def set_value(self, name: str, value: str) -> None:
         """Sets a value for a symbol in the current configuration."""
         if not self.kconf:
+            self._set_srctree()
             self._load_kconfig_sync()
         
         assert self.kconf is not None
+        self._pristine = False
+        self._tree_memo.clear()
         
         # Handle generated choice names or direct symbol selection
         if name and name.startswith("__choice_"):
@@ -301,5 +482,10 @@ class KconfigManager:
 
     def save_config(self, output_path: str) -> None:
         """Saves the current configuration to a file."""
-        if self.kconf:
-            self.kconf.write_config(output_path)
+        if not self.kconf:
+            # load_kconfig may have deferred the parse to the tree cache
+            self._set_srctree()
+            self._load_kconfig_sync()
+
+        assert self.kconf is not None
+        self.kconf.write_config(output_path)
@@ -3,7 +3,7 @@ from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
 from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional, AsyncGenerator, Tuple
+from typing import List, Dict, Any, Iterable, Iterator, Optional, AsyncGenerator, Tuple
 from urllib.parse import urlparse
 import os
 import asyncio
@@ -15,6 +15,7 @@ import re
 import uuid
 import time
 import httpx
+import orjson
 from asyncio.subprocess import Process
 
 logger = logging.getLogger('klipperfleet')
@@ -66,6 +67,9 @@ DATA_DIR: str = os.path.abspath(
 )
 PROFILES_DIR: str = os.path.join(DATA_DIR, 'profiles')
 ARTIFACTS_DIR: str = os.path.join(DATA_DIR, 'artifacts')
+CACHE_DIR: str = os.path.abspath(
+    os.path.expanduser(os.getenv('CACHE_DIR', '~/.cache/klipperfleet'))
+)
 
 
 def _detect_firmware_name(firmware_dir: str) -> str:
@@ -111,7 +115,7 @@ FIRMWARE_NAME: str = _detect_firmware_name(KLIPPER_DIR)
 os.makedirs(PROFILES_DIR, exist_ok=True)
 os.makedirs(ARTIFACTS_DIR, exist_ok=True)
 
-kconfig_mgr = KconfigManager(KLIPPER_DIR)
+kconfig_mgr = KconfigManager(KLIPPER_DIR, cache_dir=CACHE_DIR)
 build_mgr = BuildManager(KLIPPER_DIR, ARTIFACTS_DIR)
 flash_mgr = FlashManager(KLIPPER_DIR, KATAPULT_DIR)
 fleet_mgr = FleetManager(DATA_DIR)
@@ -857,11 +861,27 @@ class ConfigPreview(BaseModel):
     show_optional: bool = False
 
 
+def _stream_json_array(items: Iterable[Any]) -> Iterator[bytes]:
+    """Encodes a list as a JSON array one element at a time."""
+    yield b'['
+    for i, item in enumerate(items):
+        if i:
+            yield b','
+        yield orjson.dumps(item)
+    yield b']'
+
+
 @app.post('/config/tree')
 async def post_config_tree(
     preview: ConfigPreview, request: Request
-) -> List[Dict[str, Any]]:
-    """Returns the Kconfig tree with unsaved values applied for live preview."""
+) -> StreamingResponse:
+    """Returns the Kconfig tree with unsaved values applied for live preview.
+
+    The tree is built (or served from cache) before returning, while no other
+    request can touch the shared Kconfig, and then streamed to the client one
+    top-level item at a time instead of passing the whole tree through
+    FastAPI's response validation and encoder.
+    """
     config_path: Optional[str] = None
     if preview.profile:
         config_path = os.path.join(PROFILES_DIR, f'{preview.profile}.config')
@@ -871,7 +891,11 @@ async def post_config_tree(
             )
 
     try:
-        await kconfig_mgr.load_kconfig(config_path)
+        await kconfig_mgr.load_kconfig(
+            config_path,
+            need_kconf=bool(preview.values),
+            show_optional=preview.show_optional,
+        )
         # Apply unsaved values in multiple passes to handle deep dependencies
         for i in range(10):
             for item in preview.values:
@@ -887,7 +911,10 @@ async def post_config_tree(
                             item.value,
                         )
 
-        return kconfig_mgr.get_menu_tree(show_optional=preview.show_optional)
+        tree = kconfig_mgr.get_menu_tree(show_optional=preview.show_optional)
+        return StreamingResponse(
+            _stream_json_array(tree), media_type='application/json'
+        )
     except FileNotFoundError:
         raise HTTPException(
             status_code=404,
@@ -900,7 +927,7 @@ async def post_config_tree(
 @app.get('/config/tree')
 async def get_config_tree(
     request: Request, profile: Optional[str] = None, show_optional: bool = False
-) -> List[Dict[str, Any]]:
+) -> StreamingResponse:
     """Returns the full Kconfig tree, optionally loaded with a profile's values."""
     return await post_config_tree(
         ConfigPreview(profile=profile, show_optional=show_optional), request
@@ -922,7 +949,7 @@ async def save_profile(profile: ProfileSave) -> Dict[str, str]:
             if not os.path.exists(config_path):
                 config_path = None
 
-        await kconfig_mgr.load_kconfig(config_path)
+        await kconfig_mgr.load_kconfig(config_path, need_kconf=True)
         # Apply values in multiple passes (matching the preview endpoint) to
         # handle cascading 'select' dependencies, e.g. choosing a CAN bridge
         # communication interface triggers select USBCANBUS which must resolve
@@ -3113,10 +3140,10 @@ async def backup_export():
         }
         zf.writestr('backup_meta.json', json.dumps(meta, indent=2))
 
-        # Fleet registry
-        fleet_path = os.path.join(DATA_DIR, 'fleet.json')
-        if os.path.exists(fleet_path):
-            zf.write(fleet_path, 'fleet.json')
+        # Fleet registry (serialized from memory so journaled changes that
+        # haven't been compacted into fleet.json yet are included)
+        fleet = await fleet_mgr.get_fleet()
+        zf.writestr('fleet.json', json.dumps(fleet, indent=4))
 
         # Profiles
         profiles_dir = os.path.join(DATA_DIR, 'profiles')
@@ -3163,12 +3190,9 @@ async def backup_import(request: Request):
 
             # Restore fleet.json
             if 'fleet.json' in names:
-                fleet_data = zf.read('fleet.json')
                 # Validate JSON
-                json.loads(fleet_data)
-                fleet_path = os.path.join(DATA_DIR, 'fleet.json')
-                with open(fleet_path, 'wb') as f:
-                    f.write(fleet_data)
+                fleet_data = json.loads(zf.read('fleet.json'))
+                await fleet_mgr.replace_fleet(fleet_data)
                 restored['fleet'] = True
 
             # Restore profiles
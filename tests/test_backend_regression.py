@@ -142,6 +142,7 @@ class TestFleetManagerConcurrency:
     async def test_atomic_write_no_partial_json(self, fleet_mgr, tmp_path):
         """Fleet file should never contain partial/corrupt JSON."""
         await fleet_mgr.save_device({"id": "test", "name": "Test"})
+        await fleet_mgr.compact()
 
         # Read the raw file and verify it's valid JSON
         fleet_file = tmp_path / "fleet.json"
@@ -991,3 +992,23 @@ class TestAvrProfileAutoDetection:
         assert info["mega"]["is_can_bridge"] is False
         assert info["spider"]["is_avr"] is False
         assert info["spider"]["is_can_bridge"] is True
+
+
+# ---------------------------------------------------------------------------
+# Config tree responses are streamed as a JSON array
+# ---------------------------------------------------------------------------
+
+
+class TestStreamJsonArray:
+
+    def test_round_trips(self):
+        from backend.main import _stream_json_array
+        tree = [
+            {"type": "menu", "prompt": "Comm", "children": [{"name": "A", "visible": True}]},
+            {"name": "B", "help": None, "value": "ü"},
+        ]
+        assert json.loads(b"".join(_stream_json_array(tree))) == tree
+
+    def test_empty(self):
+        from backend.main import _stream_json_array
+        assert b"".join(_stream_json_array([])) == b"[]"
@@ -0,0 +1,400 @@
+import asyncio
+import errno
+import json
+import os
+import subprocess
+from unittest.mock import patch
+
+import pytest
+from backend.build_manager import BuildManager, _fast_copy
+
+
+def _git(cwd, *args):
+    subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    )
+
+
+@pytest.fixture
+def klipper_repo(tmp_path):
+    """A minimal git repository standing in for the Klipper checkout."""
+    repo = tmp_path / "klipper"
+    repo.mkdir()
+    _git(repo, "init", "-q")
+    _git(repo, "config", "user.email", "test@example.com")
+    _git(repo, "config", "user.name", "Test")
+    (repo / "Makefile").write_text("all:\n")
+    _git(repo, "add", "Makefile")
+    _git(repo, "commit", "-q", "-m", "initial")
+    _git(repo, "tag", "v0.12.0")
+    return repo
+
+
+@pytest.fixture
+def build_mgr(klipper_repo, tmp_path):
+    return BuildManager(str(klipper_repo), str(tmp_path / "artifacts"))
+
+
+@pytest.mark.asyncio
+async def test_get_klipper_version(build_mgr, klipper_repo):
+    head = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=klipper_repo,
+        check=True, capture_output=True, text=True,
+    ).stdout.strip()
+
+    info = await build_mgr.get_klipper_version()
+    assert info["version"].startswith("v0.12.0-0-g")
+    assert info["commit"] == head[:12]
+    assert info["date"] != "unknown"
+
+
+@pytest.mark.asyncio
+async def test_get_klipper_version_not_a_repo(tmp_path):
+    mgr = BuildManager(str(tmp_path), str(tmp_path / "artifacts"))
+    info = await mgr.get_klipper_version()
+    assert info == {"version": "unknown", "commit": "unknown", "date": "unknown"}
+
+
+@pytest.mark.asyncio
+async def test_get_klipper_version_cached_until_head_moves(build_mgr, klipper_repo):
+    first = await build_mgr.get_klipper_version()
+
+    # A cache hit only runs the dirtiness check, not describe/log
+    with patch(
+        "backend.build_manager.asyncio.create_subprocess_exec",
+        wraps=asyncio.create_subprocess_exec,
+    ) as exec_mock:
+        assert await build_mgr.get_klipper_version() == first
+    assert [c.args[:2] for c in exec_mock.call_args_list] == [("git", "status")]
+
+    (klipper_repo / "README").write_text("update\n")
+    _git(klipper_repo, "add", "README")
+    _git(klipper_repo, "commit", "-q", "-m", "second")
+
+    second = await build_mgr.get_klipper_version()
+    assert second["commit"] != first["commit"]
+    assert second["version"].startswith("v0.12.0-1-g")
+
+
+@pytest.mark.asyncio
+async def test_version_cache_invalidated_by_new_tag(build_mgr, klipper_repo):
+    (klipper_repo / "README").write_text("update\n")
+    _git(klipper_repo, "add", "README")
+    _git(klipper_repo, "commit", "-q", "-m", "second")
+    first = await build_mgr.get_klipper_version()
+    assert first["version"].startswith("v0.12.0-1-g")
+
+    _git(klipper_repo, "tag", "-a", "v0.13.0", "-m", "v0.13.0")
+    second = await build_mgr.get_klipper_version()
+    assert second["version"].startswith("v0.13.0-0-g")
+
+    fresh = BuildManager(str(klipper_repo), str(build_mgr.artifacts_dir))
+    assert await fresh.get_klipper_version() == second
+
+
+@pytest.mark.asyncio
+async def test_version_cache_persists_across_instances(build_mgr, klipper_repo, tmp_path):
+    first = await build_mgr.get_klipper_version()
+
+    fresh = BuildManager(str(klipper_repo), str(tmp_path / "artifacts"))
+    with patch(
+        "backend.build_manager.asyncio.create_subprocess_exec",
+        wraps=asyncio.create_subprocess_exec,
+    ) as exec_mock:
+        assert await fresh.get_klipper_version() == first
+    assert [c.args[:2] for c in exec_mock.call_args_list] == [("git", "status")]
+
+
+@pytest.mark.asyncio
+async def test_version_cache_tracks_working_tree_edits(build_mgr, klipper_repo):
+    clean = await build_mgr.get_klipper_version()
+    assert not clean["version"].endswith("-dirty")
+
+    (klipper_repo / "Makefile").write_text("all:\n\t@true\n")
+    dirty = await build_mgr.get_klipper_version()
+    assert dirty["version"] == clean["version"] + "-dirty"
+    assert dirty["commit"] == clean["commit"]
+
+    # Dirty versions are never persisted
+    fresh = BuildManager(str(klipper_repo), str(build_mgr.artifacts_dir))
+    assert await fresh.get_klipper_version() == dirty
+
+    (klipper_repo / "Makefile").write_text("all:\n")
+    assert await build_mgr.get_klipper_version() == clean
+    assert await fresh.get_klipper_version() == clean
+
+
+def test_fast_copy(tmp_path):
+    src = tmp_path / "klipper.bin"
+    src.write_bytes(bytes(range(256)) * 1024)
+    dst = tmp_path / "out.bin"
+    dst.write_bytes(b"stale contents that are longer than nothing")
+
+    _fast_copy(str(src), str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_fast_copy_falls_back_when_unsupported(tmp_path):
+    src = tmp_path / "klipper.elf"
+    src.write_bytes(b"\x7fELF" + b"\0" * 100)
+    dst = tmp_path / "out.elf"
+
+    with patch(
+        "backend.build_manager.os.copy_file_range",
+        side_effect=OSError(errno.EXDEV, "Invalid cross-device link"),
+        create=True,
+    ):
+        _fast_copy(str(src), str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_fast_copy_falls_back_on_short_copy(tmp_path):
+    src = tmp_path / "klipper.bin"
+    src.write_bytes(b"firmware" * 1024)
+    dst = tmp_path / "out.bin"
+
+    # First chunk copies, then the kernel reports 0 with data remaining
+    with patch(
+        "backend.build_manager.os.copy_file_range",
+        side_effect=[16, 0],
+        create=True,
+    ):
+        _fast_copy(str(src), str(dst))
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_fast_copy_preserves_mode(tmp_path):
+    src = tmp_path / "flash.sh"
+    src.write_bytes(b"#!/bin/sh\n")
+    src.chmod(0o755)
+    dst = tmp_path / "out.sh"
+
+    _fast_copy(str(src), str(dst))
+    assert (dst.stat().st_mode & 0o777) == 0o755
+
+
+@pytest.fixture
+def fake_klipper(tmp_path):
+    """A directory with a Makefile that mimics Klipper's build targets."""
+    klipper = tmp_path / "fake_klipper"
+    klipper.mkdir()
+    (klipper / "Makefile").write_text(
+        "all:\n"
+        "\t@mkdir -p out\n"
+        "\t@for i in 1 2 3; do echo \"  Compiling src/file$$i.c\"; done\n"
+        "\t@printf 'firmware' > out/klipper.bin\n"
+        "\t@printf 'no trailing newline'\n"
+        "clean:\n"
+        "\t@rm -rf out\n"
+        "olddefconfig:\n"
+        "\t@true\n"
+    )
+    # Like Klipper's own .gitignore, so build outputs don't count as changes
+    (klipper / ".gitignore").write_text("out\n.config\n.config.old\n")
+    _git(klipper, "init", "-q")
+    _git(klipper, "config", "user.email", "test@example.com")
+    _git(klipper, "config", "user.name", "Test")
+    _git(klipper, "add", "Makefile", ".gitignore")
+    _git(klipper, "commit", "-q", "-m", "initial")
+    config = tmp_path / "my_board.config"
+    config.write_text("CONFIG_MACH_STM32=y\n")
+    return klipper, config
+
+
+@pytest.mark.asyncio
+async def test_run_build_streams_lines_and_saves_artifacts(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    artifacts = tmp_path / "artifacts"
+    mgr = BuildManager(str(klipper), str(artifacts))
+
+    output = [line async for line in mgr.run_build(str(config))]
+
+    for i in (1, 2, 3):
+        assert f"  Compiling src/file{i}.c\n" in output
+    assert "no trailing newline" in output
+    assert ">>> Build successful!\n" in output
+    assert (artifacts / "my_board.bin").read_bytes() == b"firmware"
+    assert mgr.get_last_build_info("my_board") is not None
+
+
+@pytest.mark.asyncio
+async def test_custom_build_gets_parallel_makeflags(fake_klipper, tmp_path, monkeypatch):
+    klipper, config = fake_klipper
+    monkeypatch.delenv("MAKEFLAGS", raising=False)
+    mgr = BuildManager(str(klipper), str(tmp_path / "artifacts"))
+
+    output = [
+        line async for line in mgr.run_build(
+            str(config), custom_make_command='echo "flags=$MAKEFLAGS"'
+        )
+    ]
+    nproc = os.cpu_count() or 1
+    assert f"flags=-j{nproc}\n" in output
+
+
+@pytest.mark.asyncio
+async def test_run_build_skipped_when_nothing_changed(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    mgr = BuildManager(str(klipper), str(tmp_path / "artifacts"))
+    first = [line async for line in mgr.run_build(str(config))]
+    assert not any("reusing cached artifacts" in line for line in first)
+
+    with patch.object(
+        mgr, "_run_command", side_effect=AssertionError("make should not run")
+    ):
+        second = [line async for line in mgr.run_build(str(config))]
+    assert any("reusing cached artifacts" in line for line in second)
+    assert ">>> Build successful!\n" in second
+
+
+@pytest.mark.asyncio
+async def test_run_build_reruns_when_inputs_change(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    mgr = BuildManager(str(klipper), str(tmp_path / "artifacts"))
+    [line async for line in mgr.run_build(str(config))]
+
+    # Changed profile
+    config.write_text("CONFIG_MACH_RP2040=y\n")
+    output = [line async for line in mgr.run_build(str(config))]
+    assert not any("reusing cached artifacts" in line for line in output)
+
+    # Changed custom make command
+    output = [line async for line in mgr.run_build(str(config), custom_make_command="make")]
+    assert not any("reusing cached artifacts" in line for line in output)
+
+    # New Klipper commit
+    (klipper / "README").write_text("update\n")
+    _git(klipper, "add", "README")
+    _git(klipper, "commit", "-q", "-m", "second")
+    output = [line async for line in mgr.run_build(str(config), custom_make_command="make")]
+    assert not any("reusing cached artifacts" in line for line in output)
+
+
+@pytest.mark.asyncio
+async def test_run_build_reruns_after_local_source_edit(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    mgr = BuildManager(str(klipper), str(tmp_path / "artifacts"))
+    [line async for line in mgr.run_build(str(config))]
+    # Warm the version cache so the edit below happens after a cache hit
+    await mgr.get_klipper_version()
+
+    with open(klipper / "Makefile", "a") as f:
+        f.write("# local change\n")
+    output = [line async for line in mgr.run_build(str(config))]
+    assert not any("reusing cached artifacts" in line for line in output)
+    assert ">>> Build successful!\n" in output
+
+
+@pytest.mark.asyncio
+async def test_run_build_reruns_after_untracked_source_added(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    mgr = BuildManager(str(klipper), str(tmp_path / "artifacts"))
+    [line async for line in mgr.run_build(str(config))]
+
+    # e.g. a Kalico user module, which git doesn't track
+    (klipper / "src" / "extras").mkdir(parents=True)
+    (klipper / "src" / "extras" / "my_module.c").write_text("void f(void) {}\n")
+    output = [line async for line in mgr.run_build(str(config))]
+    assert not any("reusing cached artifacts" in line for line in output)
+
+
+@pytest.mark.asyncio
+async def test_run_build_reruns_when_an_artifact_is_missing(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    artifacts = tmp_path / "artifacts"
+    mgr = BuildManager(str(klipper), str(artifacts))
+    [line async for line in mgr.run_build(str(config))]
+    assert mgr.get_last_build_info("my_board")["artifacts"] == ["my_board.bin"]
+
+    (artifacts / "my_board.bin").unlink()
+    output = [line async for line in mgr.run_build(str(config))]
+    assert not any("reusing cached artifacts" in line for line in output)
+    assert (artifacts / "my_board.bin").read_bytes() == b"firmware"
+
+
+def test_build_info_loaded_from_disk(tmp_path):
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "my board.build_info.json").write_text(
+        json.dumps({"version": "v0.12.0-1-gabc", "commit": "abc"})
+    )
+    (artifacts / "broken.build_info.json").write_text("{not json")
+    (artifacts / "my board.bin").write_bytes(b"firmware")
+
+    mgr = BuildManager(str(tmp_path), str(artifacts))
+    assert mgr.get_last_build_info("my board")["commit"] == "abc"
+    assert mgr.get_last_build_info("broken") is None
+
+
+@pytest.mark.asyncio
+async def test_run_build_decodes_output_leniently(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    mgr = BuildManager(str(klipper), str(tmp_path / "artifacts"))
+
+    output = [
+        line async for line in mgr.run_build(
+            str(config), custom_make_command=r"printf 'caf\xc3\xa9\nbad \xff byte\n'"
+        )
+    ]
+    assert "café\n" in output
+    assert "bad � byte\n" in output
+
+
+@pytest.mark.asyncio
+async def test_build_info_written_atomically(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    artifacts = tmp_path / "artifacts"
+    mgr = BuildManager(str(klipper), str(artifacts))
+    [line async for line in mgr.run_build(str(config))]
+
+    info = json.loads((artifacts / "my_board.build_info.json").read_text())
+    assert info == mgr.get_last_build_info("my_board")
+    assert not (artifacts / "my_board.build_info.json.tmp").exists()
+
+
+def test_build_info_reload_tracks_disk_changes(tmp_path):
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "old.build_info.json").write_text(json.dumps({"commit": "abc"}))
+    mgr = BuildManager(str(tmp_path), str(artifacts))
+
+    # Unchanged files are not parsed again
+    with patch(
+        "backend.build_manager.orjson.loads",
+        side_effect=AssertionError("unchanged build info re-parsed"),
+    ):
+        assert mgr.get_last_build_info("old") == {"commit": "abc"}
+
+    # Profile renamed on disk
+    os.rename(artifacts / "old.build_info.json", artifacts / "new.build_info.json")
+    assert mgr.get_last_build_info("new") == {"commit": "abc"}
+    assert mgr.get_last_build_info("old") is None
+
+
+def test_corrupt_build_info_reported_once(tmp_path, caplog):
+    artifacts = tmp_path / "artifacts"
+    artifacts.mkdir()
+    (artifacts / "broken.build_info.json").write_text("{not json")
+
+    with caplog.at_level("WARNING", logger="klipperfleet.build"):
+        mgr = BuildManager(str(tmp_path), str(artifacts))
+        for _ in range(3):
+            assert mgr.get_last_build_info("broken") is None
+    assert sum("broken.build_info.json" in r.getMessage() for r in caplog.records) == 1
+
+    # Fixed on disk: picked up on the next lookup
+    (artifacts / "broken.build_info.json").write_text(json.dumps({"commit": "abc"}))
+    os.utime(artifacts / "broken.build_info.json", ns=(0, 1))
+    assert mgr.get_last_build_info("broken") == {"commit": "abc"}
+
+
+@pytest.mark.asyncio
+async def test_built_profile_dropped_when_build_info_deleted(fake_klipper, tmp_path):
+    klipper, config = fake_klipper
+    artifacts = tmp_path / "artifacts"
+    mgr = BuildManager(str(klipper), str(artifacts))
+    [line async for line in mgr.run_build(str(config))]
+    assert mgr.get_last_build_info("my_board") is not None
+
+    (artifacts / "my_board.build_info.json").unlink()
+    assert mgr.get_last_build_info("my_board") is None
@@ -1,3 +1,7 @@
+import errno
+import json
+from unittest.mock import patch
+
 import pytest
 from backend.fleet_manager import FleetManager
 
@@ -95,3 +99,96 @@ async def test_update_device_id_not_found(fleet_mgr):
 
     fleet = await fleet_mgr.get_fleet()
     assert fleet[0]["id"] == "some_other_device"
+
+
+# ---------------------------------------------------------------------------
+# Append-only journal persistence
+# ---------------------------------------------------------------------------
+
+
+@pytest.mark.asyncio
+async def test_journal_replayed_on_startup(tmp_path):
+    """Mutations survive a restart even before fleet.json is compacted."""
+    mgr = FleetManager(str(tmp_path))
+    await mgr.save_device({"id": "a", "name": "A", "profile": "p1"})
+    await mgr.save_device({"id": "b", "name": "B", "profile": "p1"})
+    await mgr.update_device_id("a", "a2")
+    await mgr.remove_device("b")
+    await mgr.rename_profile("p1", "p2")
+    assert (tmp_path / "fleet.journal").exists()
+
+    reloaded = FleetManager(str(tmp_path))
+    fleet = await reloaded.get_fleet()
+    assert fleet == [{"id": "a2", "name": "A", "profile": "p2"}]
+    # Replay compacts the journal into the snapshot
+    assert not (tmp_path / "fleet.journal").exists()
+    assert json.loads((tmp_path / "fleet.json").read_text()) == fleet
+
+
+@pytest.mark.asyncio
+async def test_journal_compacts_after_threshold(tmp_path, monkeypatch):
+    monkeypatch.setattr("backend.fleet_manager.JOURNAL_COMPACT_THRESHOLD", 3)
+    mgr = FleetManager(str(tmp_path))
+    for i in range(3):
+        await mgr.save_device({"id": f"dev_{i}"})
+
+    assert not (tmp_path / "fleet.journal").exists()
+    assert len(json.loads((tmp_path / "fleet.json").read_text())) == 3
+
+
+@pytest.mark.asyncio
+async def test_journal_skips_torn_entry(tmp_path):
+    """A partially written final journal line is ignored on replay."""
+    mgr = FleetManager(str(tmp_path))
+    await mgr.save_device({"id": "a", "name": "A"})
+    with open(tmp_path / "fleet.journal", "a") as f:
+        f.write('{"op":"upsert","dev')
+
+    fleet = await FleetManager(str(tmp_path)).get_fleet()
+    assert fleet == [{"id": "a", "name": "A"}]
+
+
+@pytest.mark.asyncio
+async def test_rename_keeps_position(fleet_mgr):
+    for dev_id in ("a", "b", "c"):
+        await fleet_mgr.save_device({"id": dev_id})
+    await fleet_mgr.save_device({"id": "b2", "old_id": "b"})
+
+    assert [d["id"] for d in await fleet_mgr.get_fleet()] == ["a", "b2", "c"]
+
+
+@pytest.mark.asyncio
+async def test_replace_fleet(fleet_mgr, tmp_path):
+    await fleet_mgr.save_device({"id": "old"})
+    await fleet_mgr.replace_fleet([{"id": "restored", "name": "R"}])
+
+    assert await fleet_mgr.get_fleet() == [{"id": "restored", "name": "R"}]
+    assert json.loads((tmp_path / "fleet.json").read_text()) == [{"id": "restored", "name": "R"}]
+
+
+@pytest.mark.asyncio
+async def test_update_live_version_skips_unchanged(fleet_mgr, tmp_path):
+    await fleet_mgr.save_device({"id": "dev1"})
+    await fleet_mgr.update_device_live_version("dev1", "v0.12.0-100")
+    journal = (tmp_path / "fleet.journal").read_bytes()
+
+    await fleet_mgr.update_device_live_version("dev1", "v0.12.0-100")
+    assert (tmp_path / "fleet.journal").read_bytes() == journal
+
+    await fleet_mgr.update_device_live_version("dev1", "v0.12.0-101")
+    assert (tmp_path / "fleet.journal").read_bytes() != journal
+    assert (await fleet_mgr.get_fleet())[0]["live_version"] == "v0.12.0-101"
+
+
+@pytest.mark.asyncio
+async def test_failed_journal_write_leaves_fleet_unchanged(fleet_mgr):
+    await fleet_mgr.save_device({"id": "dev1", "name": "Old"})
+
+    with patch(
+        "backend.fleet_manager.os.write",
+        side_effect=OSError(errno.ENOSPC, "No space left on device"),
+    ):
+        with pytest.raises(OSError):
+            await fleet_mgr.save_device({"id": "dev1", "name": "New"})
+
+    assert await fleet_mgr.get_fleet() == [{"id": "dev1", "name": "Old"}]
@@ -0,0 +1,25 @@
+import json
+from unittest.mock import patch
+
+import orjson
+import pytest
+from backend.json_store import write_json_atomic
+
+
+def test_write_json_atomic(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text("old")
+
+    write_json_atomic(str(path), {"a": [1, 2]}, option=orjson.OPT_INDENT_2)
+    assert json.loads(path.read_text()) == {"a": [1, 2]}
+    assert not (tmp_path / "data.json.tmp").exists()
+
+
+def test_write_json_atomic_keeps_old_file_on_failure(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text('{"old": true}')
+
+    with patch("backend.json_store.os.replace", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            write_json_atomic(str(path), {"new": True})
+    assert json.loads(path.read_text()) == {"old": True}
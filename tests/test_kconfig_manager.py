@@ -1,4 +1,9 @@
+import os
+import threading
+from unittest.mock import patch
+
 import pytest
+from backend import kconfig_manager
 from backend.kconfig_manager import KconfigManager
 
 @pytest.fixture
@@ -102,6 +107,7 @@ source "src/extras/Kconfig"
 
         mgr = KconfigManager(str(klipper_dir))
         # This should not crash - the script creates the missing file
+        mgr._set_srctree()
         mgr._load_kconfig_sync()
         assert mgr.kconf is not None
 
@@ -131,6 +137,7 @@ source "src/extras/Kconfig"
         script_path.chmod(0o755)
 
         mgr = KconfigManager(str(klipper_dir))
+        mgr._set_srctree()
         mgr._load_kconfig_sync()
         assert mgr.kconf is not None
 
@@ -149,6 +156,7 @@ config TEST_SYM
         (src_dir / "Kconfig").write_text(kconfig_content)
 
         mgr = KconfigManager(str(klipper_dir))
+        mgr._set_srctree()
         mgr._load_kconfig_sync()
         assert mgr.kconf is not None
 
@@ -178,6 +186,198 @@ source "src/extras/Kconfig"
 
         mgr = KconfigManager(str(klipper_dir))
         # Should not crash - fallback creates the empty file
+        mgr._set_srctree()
         mgr._load_kconfig_sync()
         assert mgr.kconf is not None
         assert (extras_dir / "Kconfig").exists()
+
+
+class TestMenuTreeCache:
+    """The default menu tree is cached on disk, keyed by the Kconfig files' mtimes/sizes."""
+
+    @pytest.fixture
+    def klipper_dir(self, kconfig_mgr):
+        return kconfig_mgr.klipper_dir
+
+    @pytest.fixture
+    def cache_dir(self, tmp_path):
+        return str(tmp_path / "cache")
+
+    @pytest.mark.asyncio
+    async def test_cache_hit_skips_parse(self, klipper_dir, cache_dir):
+        mgr = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await mgr.load_kconfig()
+        tree = mgr.get_menu_tree()
+
+        fresh = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        with patch.object(
+            kconfig_manager.kconfiglib, "Kconfig",
+            side_effect=AssertionError("Kconfig should not be parsed on a cache hit"),
+        ):
+            await fresh.load_kconfig()
+            assert fresh.get_menu_tree() == tree
+        assert fresh.kconf is None
+
+    @pytest.mark.asyncio
+    async def test_cache_invalidated_when_kconfig_changes(self, klipper_dir, cache_dir):
+        mgr = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await mgr.load_kconfig()
+        mgr.get_menu_tree()
+
+        kconfig = os.path.join(klipper_dir, "src", "Kconfig")
+        with open(kconfig, "a") as f:
+            f.write('\nconfig EXTRA_SYM\n    bool "Extra"\n')
+
+        fresh = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await fresh.load_kconfig()
+        assert fresh.kconf is not None
+        assert any(n.get("name") == "EXTRA_SYM" for n in fresh.get_menu_tree())
+
+    @pytest.mark.asyncio
+    async def test_set_value_after_cache_hit_parses(self, klipper_dir, cache_dir, tmp_path):
+        mgr = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await mgr.load_kconfig()
+        mgr.get_menu_tree()
+
+        fresh = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await fresh.load_kconfig()
+        fresh.set_value("CANBUS_INTERFACE", "y")
+        canbus = next(n for n in fresh.get_menu_tree() if n["type"] == "menu")["children"][0]
+        assert canbus["value"] == "y"
+
+        out_config = tmp_path / "test.config"
+        fresh.save_config(str(out_config))
+        assert "CONFIG_CANBUS_INTERFACE=y" in out_config.read_text()
+
+    @pytest.mark.asyncio
+    async def test_need_kconf_bypasses_cache(self, klipper_dir, cache_dir):
+        mgr = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await mgr.load_kconfig()
+        mgr.get_menu_tree()
+
+        fresh = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await fresh.load_kconfig(need_kconf=True)
+        assert fresh.kconf is not None
+        with patch.object(
+            kconfig_manager.kconfiglib, "Kconfig",
+            side_effect=AssertionError("Kconfig should already be parsed"),
+        ):
+            fresh.set_value("CANBUS_INTERFACE", "y")
+
+    @pytest.mark.asyncio
+    async def test_partial_cache_parses_off_event_loop(self, klipper_dir, cache_dir):
+        mgr = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await mgr.load_kconfig()
+        mgr.get_menu_tree()
+
+        # Only the default tree is cached; asking for the optional one must
+        # parse inside load_kconfig, not later in get_menu_tree
+        fresh = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await fresh.load_kconfig(show_optional=True)
+        assert fresh.kconf is not None
+        with patch.object(
+            kconfig_manager.kconfiglib, "Kconfig",
+            side_effect=AssertionError("Kconfig should already be parsed"),
+        ):
+            fresh.get_menu_tree(show_optional=True)
+
+        # Both trees are cached now
+        again = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await again.load_kconfig(show_optional=True)
+        assert again.kconf is None
+
+    @pytest.mark.asyncio
+    async def test_profile_trees_not_cached(self, klipper_dir, cache_dir, tmp_path):
+        config = tmp_path / "profile.config"
+        config.write_text('CONFIG_BOARD_MCU="rp2040"\n')
+
+        mgr = KconfigManager(klipper_dir, cache_dir=cache_dir)
+        await mgr.load_kconfig(str(config))
+        mgr.get_menu_tree()
+        assert not os.path.exists(cache_dir)
+
+
+def test_menu_tree_memoized_until_set_value(kconfig_mgr):
+    tree = kconfig_mgr.get_menu_tree()
+    assert kconfig_mgr.get_menu_tree() is tree
+    assert kconfig_mgr.get_menu_tree(show_optional=True) is not tree
+
+    kconfig_mgr.set_value("CANBUS_INTERFACE", "y")
+    updated = kconfig_mgr.get_menu_tree()
+    assert updated is not tree
+    comm_menu = next(n for n in updated if n["type"] == "menu")
+    assert comm_menu["children"][0]["value"] == "y"
+
+
+@pytest.mark.asyncio
+async def test_menu_tree_memo_cleared_on_reload(kconfig_mgr):
+    await kconfig_mgr.load_kconfig()
+    tree = kconfig_mgr.get_menu_tree()
+    await kconfig_mgr.load_kconfig()
+    assert kconfig_mgr.get_menu_tree() is not tree
+
+
+def test_load_does_not_chdir(kconfig_mgr):
+    """Parsing must not touch the process-wide CWD."""
+    cwd = os.getcwd()
+    with patch("os.chdir", side_effect=AssertionError("os.chdir called")):
+        kconfig_mgr._set_srctree()
+        kconfig_mgr._load_kconfig_sync()
+    assert os.getcwd() == cwd
+    assert "BOARD_MCU" in kconfig_mgr.kconf.syms
+
+
+@pytest.mark.asyncio
+async def test_each_manager_parses_its_own_tree(tmp_path):
+    """srctree is process-wide; each load must point it at its own tree."""
+    managers = {}
+    for name in ("A", "B"):
+        src_dir = tmp_path / f"klipper_{name}" / "src"
+        src_dir.mkdir(parents=True)
+        (src_dir / "Kconfig").write_text('mainmenu "Test"\nsource "src/extra.Kconfig"\n')
+        (src_dir / "extra.Kconfig").write_text(f'config FROM_{name}\n    bool "{name}"\n')
+        managers[name] = KconfigManager(str(src_dir.parent))
+
+    await managers["A"].load_kconfig()
+    await managers["B"].load_kconfig()
+    await managers["A"].load_kconfig()
+    assert "FROM_A" in managers["A"].kconf.syms
+    assert "FROM_B" not in managers["A"].kconf.syms
+    assert "FROM_B" in managers["B"].kconf.syms
+
+
+@pytest.mark.asyncio
+async def test_load_kconfig_runs_off_event_loop(kconfig_mgr):
+    loop_thread = threading.get_ident()
+    parse_threads = []
+    real_load = kconfig_mgr._load_kconfig_sync
+
+    def spy(config_file=None):
+        parse_threads.append(threading.get_ident())
+        real_load(config_file)
+
+    with patch.object(kconfig_mgr, "_load_kconfig_sync", side_effect=spy):
+        await kconfig_mgr.load_kconfig()
+    assert parse_threads and parse_threads[0] != loop_thread
+    assert kconfig_mgr.kconf is not None
+
+
+def test_show_optional_forces_want_symbols(tmp_path):
+    src_dir = tmp_path / "klipper" / "src"
+    src_dir.mkdir(parents=True)
+    (src_dir / "Kconfig").write_text("""
+mainmenu "Klipper Configuration"
+config HIDE
+    bool
+    default n
+config WANT_GPIO_BITBANGING
+    bool "Support GPIO bit-banging devices" if HIDE
+config OTHER_SYM
+    bool "Other" if HIDE
+""")
+    mgr = KconfigManager(str(tmp_path / "klipper"))
+
+    assert mgr.get_menu_tree() == []
+    tree = mgr.get_menu_tree(show_optional=True)
+    assert [n["name"] for n in tree] == ["WANT_GPIO_BITBANGING"]
+    assert tree[0]["visible"] is True